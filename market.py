@@ -1,3 +1,4 @@
+import asyncio
 import datetime
 import logging.config
 from environs import Env
@@ -5,7 +6,7 @@ from seller import download_stock
 
 import requests
 
-from seller import divide, price_conversion
+from seller import COUNT_TO_STOCK, divide, index_remnants, price_conversion
 
 logger = logging.getLogger(__file__)
 
@@ -151,12 +152,12 @@ def get_offer_ids(campaign_id, market_token):
     return offer_ids
 
 
-def create_stocks(watch_remnants, offer_ids, warehouse_id):
+def create_stocks(remnants_index, offer_ids, warehouse_id):
     """
     Сформировать список остатков.
 
     Args:
-        watch_remnants (list): Список содержащий информацию об остатках часов.
+        remnants_index (dict): Индекс остатков часов, построенный index_remnants.
         offer_ids (str): Список содержащий артикулы товаров.
         warehouse_id (str): id склада.
 
@@ -164,47 +165,31 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
         list: Список содержащий обновленную информацию об остатках часов.
 
     Examples:
-        >>> create_stocks([{"Код": "123", "Количество": ">10"}], ["123"], "warehouse123")
+        >>> create_stocks(index_remnants([{"Код": "123", "Количество": ">10"}]), ["123"], "warehouse123")
         [{'offer_id': '123', 'stock': 100}]
 
     Raises:
-        AttributeError: Если атрибуты offer_ids, warehouse_id не являются строками, watch_remnants не является списком.
+        AttributeError: Если атрибуты offer_ids, warehouse_id не являются строками, remnants_index не является словарем.
     """
-    # Уберем то, что не загружено в market
     stocks = list()
     date = str(datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append(
-                {
-                    "sku": str(watch.get("Код")),
-                    "warehouseId": warehouse_id,
-                    "items": [
-                        {
-                            "count": stock,
-                            "type": "FIT",
-                            "updatedAt": date,
-                        }
-                    ],
-                }
-            )
-            offer_ids.remove(str(watch.get("Код")))
-    # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
+    for offer_id in dict.fromkeys(offer_ids):
+        watch = remnants_index.get(offer_id)
+        # Товара нет в остатках - выставляем ноль
+        if watch is None:
+            stock = 0
+        else:
+            quantity = watch.get("Количество")
+            stock = COUNT_TO_STOCK.get(str(quantity))
+            if stock is None:
+                stock = int(quantity)
         stocks.append(
             {
                 "sku": offer_id,
                 "warehouseId": warehouse_id,
                 "items": [
                     {
-                        "count": 0,
+                        "count": stock,
                         "type": "FIT",
                         "updatedAt": date,
                     }
@@ -214,83 +199,89 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
     return stocks
 
 
-def create_prices(watch_remnants, offer_ids):
+def create_prices(remnants_index, offer_ids):
     """
     Создать цены на товары.
 
     Args:
-        watch_remnants (list): Список содержащий информацию об остатках часов.
+        remnants_index (dict): Индекс остатков часов, построенный index_remnants.
         offer_ids (list): Список артикулов товаров выставленных на Озон.
 
     Returns:
         list: Список содержащий информацию о новых ценах на товары.
 
     Examples:
-        >>> create_prices([{"Код": "123", "Цена": "5'990.00 руб."}], ["123"])
+        >>> create_prices(index_remnants([{"Код": "123", "Цена": "5'990.00 руб."}]), ["123"])
         [{'auto_action_enabled': 'UNKNOWN', 'currency_code': 'RUB',
         'offer_id': '123', 'old_price': '0', 'price': '5990'}]
 
     Raises:
-        AttributeError: Если атрибуты watch_remnants, offer_ids не являются списками.
+        AttributeError: Если remnants_index не является словарем.
     """
     prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "id": str(watch.get("Код")),
-                # "feed": {"id": 0},
-                "price": {
-                    "value": int(price_conversion(watch.get("Цена"))),
-                    # "discountBase": 0,
-                    "currencyId": "RUR",
-                    # "vat": 0,
-                },
-                # "marketSku": 0,
-                # "shopSku": "string",
-            }
-            prices.append(price)
+    for offer_id in dict.fromkeys(offer_ids):
+        watch = remnants_index.get(offer_id)
+        if watch is None:
+            continue
+        price = {
+            "id": offer_id,
+            # "feed": {"id": 0},
+            "price": {
+                "value": int(price_conversion(watch.get("Цена"))),
+                # "discountBase": 0,
+                "currencyId": "RUR",
+                # "vat": 0,
+            },
+            # "marketSku": 0,
+            # "shopSku": "string",
+        }
+        prices.append(price)
     return prices
 
 
-async def upload_prices(watch_remnants, campaign_id, market_token):
+async def upload_prices(remnants_index, campaign_id, market_token, offer_ids=None):
     """
     Асинхронно загружает обновленные цены на товары.
 
     Args:
-        watch_remnants (dict): Словарь с остатками товара из файла excel.
+        remnants_index (dict): Индекс остатков товара из файла excel, построенный index_remnants.
         campaign_id (str): Идентификатор кампании на Яндекс Маркете.
         market_token (str): Токен доступа к API Яндекс Маркета.
+        offer_ids (list): Артикулы товаров кампании. Если не переданы, будут запрошены через API.
 
     Returns:
         list: Список обновленных цен товаров.
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
-    prices = create_prices(watch_remnants, offer_ids)
-    for some_prices in list(divide(prices, 500)):
+    if offer_ids is None:
+        offer_ids = get_offer_ids(campaign_id, market_token)
+    prices = create_prices(remnants_index, offer_ids)
+    for some_prices in divide(prices, 500):
         update_price(some_prices, campaign_id, market_token)
     return prices
 
 
-async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id):
+async def upload_stocks(
+    remnants_index, campaign_id, market_token, warehouse_id, offer_ids=None
+):
     """
     Асинхронно обновляет остатки товаров.
 
     Args:
-        watch_remnants (dict): Словарь с остатками товара из файла excel.
+        remnants_index (dict): Индекс остатков товара из файла excel, построенный index_remnants.
         campaign_id (str): Идентификатор кампании на Яндекс Маркете.
         market_token (str): Токен доступа к API Яндекс Маркета.
         warehouse_id (str) : Идентификатор склада.
+        offer_ids (list): Артикулы товаров кампании. Если не переданы, будут запрошены через API.
 
     Returns:
         list: Список обновленных данных о наличии товара и отфильтрованных оставшихся товаров, которые не расны нулю.
     """
-    offer_ids = get_offer_ids(campaign_id, market_token)
-    stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
-    for some_stock in list(divide(stocks, 2000)):
+    if offer_ids is None:
+        offer_ids = get_offer_ids(campaign_id, market_token)
+    stocks = create_stocks(remnants_index, offer_ids, warehouse_id)
+    for some_stock in divide(stocks, 2000):
         update_stocks(some_stock, campaign_id, market_token)
-    not_empty = list(
-        filter(lambda stock: (stock.get("items")[0].get("count") != 0), stocks)
-    )
+    not_empty = [stock for stock in stocks if stock["items"][0]["count"] != 0]
     return not_empty, stocks
 
 
@@ -302,25 +293,29 @@ def main():
     warehouse_fbs_id = env.str("WAREHOUSE_FBS_ID")
     warehouse_dbs_id = env.str("WAREHOUSE_DBS_ID")
 
-    watch_remnants = download_stock()
+    remnants_index = index_remnants(download_stock())
     try:
         # FBS
         offer_ids = get_offer_ids(campaign_fbs_id, market_token)
         # Обновить остатки FBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
-        for some_stock in list(divide(stocks, 2000)):
+        stocks = create_stocks(remnants_index, offer_ids, warehouse_fbs_id)
+        for some_stock in divide(stocks, 2000):
             update_stocks(some_stock, campaign_fbs_id, market_token)
         # Поменять цены FBS
-        upload_prices(watch_remnants, campaign_fbs_id, market_token)
+        asyncio.run(
+            upload_prices(remnants_index, campaign_fbs_id, market_token, offer_ids)
+        )
 
         # DBS
         offer_ids = get_offer_ids(campaign_dbs_id, market_token)
         # Обновить остатки DBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_dbs_id)
-        for some_stock in list(divide(stocks, 2000)):
+        stocks = create_stocks(remnants_index, offer_ids, warehouse_dbs_id)
+        for some_stock in divide(stocks, 2000):
             update_stocks(some_stock, campaign_dbs_id, market_token)
         # Поменять цены DBS
-        upload_prices(watch_remnants, campaign_dbs_id, market_token)
+        asyncio.run(
+            upload_prices(remnants_index, campaign_dbs_id, market_token, offer_ids)
+        )
     except requests.exceptions.ReadTimeout:
         print("Превышено время ожидания...")
     except requests.exceptions.ConnectionError as error:
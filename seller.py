@@ -1,15 +1,59 @@
+import asyncio
+import functools
 import io
 import logging.config
 import os
+import pickle
 import re
+import shutil
+import tempfile
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from environs import Env
 
-import pandas as pd
+import openpyxl
+import orjson
 import requests
+import xlrd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__file__)
 
+UPLOAD_CONCURRENCY = 8
+REQUEST_TIMEOUT = (3.05, 30)
+HEADER_ROW = 18
+REMNANT_COLUMNS = ("Код", "Количество", "Цена")
+# Особые остатки casio: ">10" выставляем как 100, последний экземпляр не выставляем
+COUNT_TO_STOCK = {">10": 100, "1": 0}
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "seller-apis")
+CACHE_META_FILE = os.path.join(CACHE_DIR, "meta.json")
+CACHE_REMNANTS_FILE = os.path.join(CACHE_DIR, "ostatki.pkl")
+# Увеличить при любом изменении разбора ostatki, чтобы сбросить старый кэш
+CACHE_VERSION = 2
+_NONDIGIT_RE = re.compile(r"[^0-9]")
+_PRICE_DROP = str.maketrans("", "", "'., руб\u00a0\t\n")
+
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=5,
+            # Таймаут чтения не повторяем: запрос мог уже дойти до Ozon
+            read=False,
+            backoff_factor=0.5,
+            status_forcelist=[429, 500, 502, 503, 504],
+            # Запросы к Ozon перезаписывают цены и остатки целиком, их можно повторять
+            allowed_methods=["GET", "POST"],
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        ),
+    ),
+)
+
 
 def get_product_list(last_id, client_id, seller_token):
     """
@@ -35,6 +79,7 @@ def get_product_list(last_id, client_id, seller_token):
     headers = {
         "Client-Id": client_id,
         "Api-Key": seller_token,
+        "Content-Type": "application/json",
     }
     payload = {
         "filter": {
@@ -43,12 +88,55 @@ def get_product_list(last_id, client_id, seller_token):
         "last_id": last_id,
         "limit": 1000,
     }
-    response = requests.post(url, json=payload, headers=headers)
+    response = _SESSION.post(
+        url, data=orjson.dumps(payload), headers=headers, timeout=REQUEST_TIMEOUT
+    )
     response.raise_for_status()
-    response_object = response.json()
+    response_object = orjson.loads(response.content)
     return response_object.get("result")
 
 
+def iter_offer_ids(client_id, seller_token):
+    """
+    Постранично получать артикулы товаров магазина озон.
+
+    Артикулы отдаются по мере загрузки страниц, поэтому в памяти
+    одновременно хранится не больше двух страниц ответа: текущая и
+    запрошенная заранее следующая.
+
+    Args:
+        client_id (str): ID клиента.
+        seller_token (str): Токен продавца.
+
+    Yields:
+        str: Артикул товара.
+
+    Example:
+        >>> set(iter_offer_ids("12345", "token123"))
+        {'offer_001', 'offer_002', 'offer_003'}
+
+    Raises:
+        AttributeError: Если атрибуты client_id, seller_token не являются строками.
+    """
+    received = 0
+    # Следующая страница запрашивается в фоне, пока отдаются артикулы текущей
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_page = executor.submit(get_product_list, "", client_id, seller_token)
+        while next_page is not None:
+            some_prod = next_page.result()
+            items = some_prod.get("items")
+            received += len(items)
+            last_id = some_prod.get("last_id")
+            if items and last_id and received < some_prod.get("total"):
+                next_page = executor.submit(
+                    get_product_list, last_id, client_id, seller_token
+                )
+            else:
+                next_page = None
+            for product in items:
+                yield product.get("offer_id")
+
+
 def get_offer_ids(client_id, seller_token):
     """
     Получить артикулы товаров магазина озон.
@@ -67,19 +155,7 @@ def get_offer_ids(client_id, seller_token):
     Raises:
         AttributeError: Если атрибуты client_id, seller_token не являются строками.
     """
-    last_id = ""
-    product_list = []
-    while True:
-        some_prod = get_product_list(last_id, client_id, seller_token)
-        product_list.extend(some_prod.get("items"))
-        total = some_prod.get("total")
-        last_id = some_prod.get("last_id")
-        if total == len(product_list):
-            break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer_id"))
-    return offer_ids
+    return list(iter_offer_ids(client_id, seller_token))
 
 
 def update_price(prices: list, client_id, seller_token):
@@ -107,11 +183,14 @@ def update_price(prices: list, client_id, seller_token):
     headers = {
         "Client-Id": client_id,
         "Api-Key": seller_token,
+        "Content-Type": "application/json",
     }
     payload = {"prices": prices}
-    response = requests.post(url, json=payload, headers=headers)
+    response = _SESSION.post(
+        url, data=orjson.dumps(payload), headers=headers, timeout=REQUEST_TIMEOUT
+    )
     response.raise_for_status()
-    return response.json()
+    return orjson.loads(response.content)
 
 
 def update_stocks(stocks: list, client_id, seller_token):
@@ -139,17 +218,161 @@ def update_stocks(stocks: list, client_id, seller_token):
     headers = {
         "Client-Id": client_id,
         "Api-Key": seller_token,
+        "Content-Type": "application/json",
     }
     payload = {"stocks": stocks}
-    response = requests.post(url, json=payload, headers=headers)
+    response = _SESSION.post(
+        url, data=orjson.dumps(payload), headers=headers, timeout=REQUEST_TIMEOUT
+    )
     response.raise_for_status()
-    return response.json()
+    return orjson.loads(response.content)
+
+
+def excel_value(value):
+    """
+    Привести значение ячейки Excel к виду, который возвращал pandas.
+
+    Args:
+        value: Значение ячейки.
+
+    Returns:
+        Пустую строку для пустой ячейки, int для целых чисел, иначе само значение.
+
+    Examples:
+        >>> excel_value(12345.0)
+        12345
+        >>> excel_value(None)
+        ''
+    """
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def rows_to_records(rows):
+    """
+    Собрать список остатков из строк таблицы, первая из которых является заголовком.
+
+    Сохраняются только колонки REMNANT_COLUMNS и только строки с заполненным кодом.
+
+    Args:
+        rows (iter): Итератор кортежей значений ячеек, начиная со строки заголовка.
+
+    Returns:
+        list: Список словарей вида {колонка: значение}.
+
+    Examples:
+        >>> rows_to_records(iter([
+        ...     ("Модель", "Код", "Количество", "Цена"),
+        ...     ("Группа G-Shock",),
+        ...     ("A158WA", 123.0, ">10", "5'990.00 руб."),
+        ... ]))
+        [{'Код': 123, 'Количество': '>10', 'Цена': "5'990.00 руб."}]
+
+    Raises:
+        ValueError: Если в заголовке нет одной из колонок REMNANT_COLUMNS.
+    """
+    header = [excel_value(name) for name in next(rows)]
+    columns = [(name, header.index(name)) for name in REMNANT_COLUMNS]
+    code_index = header.index("Код")
+    records = []
+    for row in rows:
+        # Строки могут быть короче заголовка, недостающие ячейки считаем пустыми
+        width = len(row)
+        if code_index >= width or excel_value(row[code_index]) == "":
+            continue
+        records.append(
+            {
+                name: excel_value(row[index] if index < width else None)
+                for name, index in columns
+            }
+        )
+    return records
+
+
+def read_remnants(data):
+    """
+    Прочитать остатки часов из содержимого файла Excel.
+
+    Файл ostatki.xls может оказаться как настоящим xls, так и xlsx,
+    поэтому формат определяется по сигнатуре файла.
+
+    Args:
+        data (bytes): Содержимое файла с остатками.
+
+    Returns:
+        list: Список словарей, содержащих данные об остатках товаров.
 
+    Raises:
+        ValueError: Если в заголовке нет одной из колонок REMNANT_COLUMNS.
+    """
+    if data[:4] == b"PK\x03\x04":
+        workbook = openpyxl.load_workbook(
+            io.BytesIO(data), read_only=True, data_only=True
+        )
+        try:
+            rows = workbook.active.iter_rows(min_row=HEADER_ROW, values_only=True)
+            return rows_to_records(rows)
+        finally:
+            workbook.close()
+    workbook = xlrd.open_workbook(file_contents=data, on_demand=True)
+    try:
+        sheet = workbook.sheet_by_index(0)
+        rows = (sheet.row_values(i) for i in range(HEADER_ROW - 1, sheet.nrows))
+        return rows_to_records(rows)
+    finally:
+        workbook.release_resources()
+
+
+def read_stock_cache():
+    """
+    Прочитать метаданные и остатки, сохраненные при прошлом скачивании.
 
+    Returns:
+        tuple: Словарь с ETag и Last-Modified и список остатков, либо ({}, None),
+        если кэша нет или он записан с другим CACHE_VERSION.
+    """
+    try:
+        with open(CACHE_META_FILE, "rb") as file:
+            meta = orjson.loads(file.read())
+        # Кэш, разобранный другой версией скрипта, не используем
+        if meta.get("version") != CACHE_VERSION:
+            return {}, None
+        with open(CACHE_REMNANTS_FILE, "rb") as file:
+            watch_remnants = pickle.load(file)
+    except (OSError, ValueError, pickle.UnpicklingError, EOFError):
+        return {}, None
+    return meta, watch_remnants
+
+
+def write_stock_cache(meta, watch_remnants):
+    """
+    Сохранить остатки и метаданные ответа сервера для следующего запуска.
+
+    Args:
+        meta (dict): ETag и Last-Modified ответа сервера.
+        watch_remnants (list): Список словарей, содержащих данные об остатках товаров.
+    """
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(CACHE_REMNANTS_FILE, "wb") as file:
+            pickle.dump(watch_remnants, file, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(CACHE_META_FILE, "wb") as file:
+            file.write(orjson.dumps({**meta, "version": CACHE_VERSION}))
+    except OSError as error:
+        logger.warning("Не удалось сохранить кэш остатков: %s", error)
+
+
+@functools.lru_cache(maxsize=1)
 def download_stock():
     """
     Скачать файл ostatki с сайта casio.
 
+    Файл запрашивается с If-None-Match/If-Modified-Since. Если на сервере он
+    не изменился, остатки берутся из кэша в ~/.cache/seller-apis.
+
     Returns:
         list: Список словарей, содержащих данные об остатках товаров.
 
@@ -160,85 +383,117 @@ def download_stock():
     Raises:
         HTTPError: Если произошла ошибка при выполнении запроса.
     """
+    meta, cached_remnants = read_stock_cache()
+    headers = {}
+    if cached_remnants is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
     # Скачать остатки с сайта
     casio_url = "https://timeworld.ru/upload/files/ostatki.zip"
-    session = requests.Session()
-    response = session.get(casio_url)
-    response.raise_for_status()
-    with response, zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-        archive.extractall(".")
+    with _SESSION.get(
+        casio_url, stream=True, headers=headers, timeout=(3.05, 60)
+    ) as response:
+        if response.status_code == 304:
+            return cached_remnants
+        response.raise_for_status()
+        meta = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        response.raw.decode_content = True
+        with tempfile.SpooledTemporaryFile(max_size=32 * 1024 * 1024) as buffer:
+            shutil.copyfileobj(response.raw, buffer, length=1 << 16)
+            buffer.seek(0)
+            with zipfile.ZipFile(buffer) as archive:
+                with archive.open("ostatki.xls") as excel_file:
+                    data = excel_file.read()
     # Создаем список остатков часов:
-    excel_file = "ostatki.xls"
-    watch_remnants = pd.read_excel(
-        io=excel_file,
-        na_values=None,
-        keep_default_na=False,
-        header=17,
-    ).to_dict(orient="records")
-    os.remove("./ostatki.xls")  # Удалить файл
+    watch_remnants = read_remnants(data)
+    # Без ETag и Last-Modified проверить актуальность кэша не получится
+    if meta["etag"] or meta["last_modified"]:
+        write_stock_cache(meta, watch_remnants)
     return watch_remnants
 
 
-def create_stocks(watch_remnants, offer_ids):
+def index_remnants(watch_remnants):
     """
-    Создать список остатков товаров.
+    Построить индекс остатков часов по коду товара.
 
     Args:
         watch_remnants (list): Список содержащий информацию об остатках часов.
+
+    Returns:
+        dict: Словарь {код товара: строка остатков}. При повторе кода остается первая строка.
+
+    Example:
+        >>> index_remnants([{"Код": 123, "Количество": ">10"}])
+        {'123': {'Код': 123, 'Количество': '>10'}}
+    """
+    remnants_index = {}
+    for watch in watch_remnants:
+        remnants_index.setdefault(str(watch.get("Код")), watch)
+    return remnants_index
+
+
+def create_stocks(remnants_index, offer_ids):
+    """
+    Создать список остатков товаров.
+
+    Args:
+        remnants_index (dict): Индекс остатков часов, построенный index_remnants.
         offer_ids (list): Список артикулов товаров выставленных на Озон.
 
     Returns:
         list: Список содержащий обновленную информацию об остатках часов.
 
     Example:
-        >>> watch_remnants = [
+        >>> remnants_index = index_remnants([
         ...     {"Код": "123", "Количество": ">10"},
         ...     {"Код": "456", "Количество": "1"},
-        ... ]
-        >>> offer_ids = ["123", "456"]
-        >>> create_stocks(watch_remnants, offer_ids)
+        ... ])
+        >>> offer_ids = ["123", "456", "789"]
+        >>> create_stocks(remnants_index, offer_ids)
         [
-            {"offer_id": "123", "stock": 10},
-            {"offer_id": "456", "stock": 1}
+            {"offer_id": "123", "stock": 100},
+            {"offer_id": "456", "stock": 0},
+            {"offer_id": "789", "stock": 0}
         ]
 
     Raises:
-        AttributeError: Если атрибуты watch_remnants, offer_ids не являются списками.
+        AttributeError: Если remnants_index не является словарем.
     """
-    # Уберем то, что не загружено в seller
     stocks = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append({"offer_id": str(watch.get("Код")), "stock": stock})
-            offer_ids.remove(str(watch.get("Код")))
-    # Добавим недостающее из загруженного:
-    for offer_id in offer_ids:
-        stocks.append({"offer_id": offer_id, "stock": 0})
+    for offer_id in dict.fromkeys(offer_ids):
+        watch = remnants_index.get(offer_id)
+        # Товара нет в остатках - выставляем ноль
+        if watch is None:
+            stocks.append({"offer_id": offer_id, "stock": 0})
+            continue
+        quantity = watch.get("Количество")
+        stock = COUNT_TO_STOCK.get(str(quantity))
+        if stock is None:
+            stock = int(quantity)
+        stocks.append({"offer_id": offer_id, "stock": stock})
     return stocks
 
 
-def create_prices(watch_remnants, offer_ids):
+def create_prices(remnants_index, offer_ids):
     """
     Создать цены на товары.
 
     Args:
-        watch_remnants (list): Список содержащий информацию об остатках часов.
+        remnants_index (dict): Индекс остатков часов, построенный index_remnants.
         offer_ids (list): Список артикулов товаров выставленных на Озон.
 
     Returns:
         list: Список содержащий информацию о новых ценах на товары.
 
     Examples:
-        >>>create_prices(
+        >>>create_prices(index_remnants(
         >>>[{"Код": "123", "Цена": "5'990.00 руб."},
-        >>>{"Код": "456", "Цена": "7'500.50 руб."}], ["123", "789"])
+        >>>{"Код": "456", "Цена": "7'500.50 руб."}]), ["123", "456", "789"])
 
     [{'auto_action_enabled': 'UNKNOWN', 'currency_code': 'RUB',
     'offer_id': '123', 'old_price': '0', 'price': '5990'},
@@ -246,19 +501,21 @@ def create_prices(watch_remnants, offer_ids):
      offer_id': '456', 'old_price': '0', 'price': '7500'}]
 
     Raises:
-        AttributeError: Если атрибуты watch_remnants, offer_ids не являются списками.
+        AttributeError: Если remnants_index не является словарем.
         """
     prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "auto_action_enabled": "UNKNOWN",
-                "currency_code": "RUB",
-                "offer_id": str(watch.get("Код")),
-                "old_price": "0",
-                "price": price_conversion(watch.get("Цена")),
-            }
-            prices.append(price)
+    for offer_id in dict.fromkeys(offer_ids):
+        watch = remnants_index.get(offer_id)
+        if watch is None:
+            continue
+        price = {
+            "auto_action_enabled": "UNKNOWN",
+            "currency_code": "RUB",
+            "offer_id": offer_id,
+            "old_price": "0",
+            "price": price_conversion(watch.get("Цена")),
+        }
+        prices.append(price)
     return prices
 
 
@@ -279,7 +536,11 @@ def price_conversion(price: str) -> str:
     Raises:
         AttributeError: Если атрибут price не является строкой.
     """
-    return re.sub("[^0-9]", "", price.split(".")[0])
+    digits = price.split(".", 1)[0].translate(_PRICE_DROP)
+    if digits.isascii() and digits.isdigit():
+        return digits
+    # Встретились неизвестные символы - убираем все, кроме цифр
+    return _NONDIGIT_RE.sub("", digits)
 
 
 def divide(lst: list, n: int):
@@ -304,43 +565,78 @@ def divide(lst: list, n: int):
         yield lst[i : i + n]
 
 
-async def upload_prices(watch_remnants, client_id, seller_token):
+async def run_in_executor(semaphore, func, *args):
+    """
+    Выполнить блокирующую функцию в пуле потоков, ограничив число одновременных вызовов.
+
+    Args:
+        semaphore (asyncio.Semaphore): Семафор, ограничивающий количество одновременных запросов.
+        func (callable): Блокирующая функция, например update_price.
+        *args: Аргументы функции func.
+
+    Returns:
+        Результат вызова func.
+    """
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        return await loop.run_in_executor(None, func, *args)
+
+
+async def upload_prices(remnants_index, client_id, seller_token, offer_ids=None):
     """
     Асинхронно загружает данные о ценах на товары на площадку Озон.
 
     Args:
-        watch_remnants (list): Список с остатками.
+        remnants_index (dict): Индекс остатков, построенный index_remnants.
         client_id (str): Идентификатор клиента на Озон.
         seller_token (str): Токен продавца для API Озон.
+        offer_ids (list): Артикулы товаров на Озон. Если не переданы, будут запрошены через API.
 
     Returns:
         list: Список обновленных цен, которые будут загружены на площадку.
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
-    prices = create_prices(watch_remnants, offer_ids)
-    for some_price in list(divide(prices, 1000)):
-        update_price(some_price, client_id, seller_token)
+    if offer_ids is None:
+        offer_ids = get_offer_ids(client_id, seller_token)
+    prices = create_prices(remnants_index, offer_ids)
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    await asyncio.gather(
+        *[
+            run_in_executor(
+                semaphore, update_price, some_price, client_id, seller_token
+            )
+            for some_price in divide(prices, 1000)
+        ]
+    )
     return prices
 
 
-async def upload_stocks(watch_remnants, client_id, seller_token):
+async def upload_stocks(remnants_index, client_id, seller_token, offer_ids=None):
     """
     Асинхронно загружает данные об остатках на товары на площадку Озон.
 
     Args:
-        watch_remnants (list): Список с остатками.
+        remnants_index (dict): Индекс остатков, построенный index_remnants.
         client_id (str): Идентификатор клиента на Озон.
         seller_token (str): Токен продавца для API Озон.
+        offer_ids (list): Артикулы товаров на Озон. Если не переданы, будут запрошены через API.
 
     Returns:
         not_empty (list): Список отфильтрованных оставшихся товаров с количеством, которое не равно нулу.
         stocks (list): Список остатков товаров.
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
-    stocks = create_stocks(watch_remnants, offer_ids)
-    for some_stock in list(divide(stocks, 100)):
-        update_stocks(some_stock, client_id, seller_token)
-    not_empty = list(filter(lambda stock: (stock.get("stock") != 0), stocks))
+    if offer_ids is None:
+        offer_ids = get_offer_ids(client_id, seller_token)
+    stocks = create_stocks(remnants_index, offer_ids)
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    await asyncio.gather(
+        *[
+            run_in_executor(
+                semaphore, update_stocks, some_stock, client_id, seller_token
+            )
+            for some_stock in divide(stocks, 100)
+        ]
+    )
+    not_empty = [stock for stock in stocks if stock["stock"] != 0]
     return not_empty, stocks
 
 
@@ -350,15 +646,11 @@ def main():
     client_id = env.str("CLIENT_ID")
     try:
         offer_ids = get_offer_ids(client_id, seller_token)
-        watch_remnants = download_stock()
+        remnants_index = index_remnants(download_stock())
         # Обновить остатки
-        stocks = create_stocks(watch_remnants, offer_ids)
-        for some_stock in list(divide(stocks, 100)):
-            update_stocks(some_stock, client_id, seller_token)
+        asyncio.run(upload_stocks(remnants_index, client_id, seller_token, offer_ids))
         # Поменять цены
-        prices = create_prices(watch_remnants, offer_ids)
-        for some_price in list(divide(prices, 900)):
-            update_price(some_price, client_id, seller_token)
+        asyncio.run(upload_prices(remnants_index, client_id, seller_token, offer_ids))
     except requests.exceptions.ReadTimeout:
         print("Превышено время ожидания...")
     except requests.exceptions.ConnectionError as error: